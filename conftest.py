@@ -0,0 +1,2 @@
+# Keeps the repository root on sys.path so the tests import the local
+# segish package without it being installed
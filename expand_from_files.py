@@ -2,16 +2,28 @@ import argparse
 
 from segish.expand_annotations import load_and_expand
 
-parser = argparse.ArgumentParser(description='Expand annotations based on similar pixels.')
-parser.add_argument('image_path', type=str, help='Path to RGB image')
-parser.add_argument('annotation_paths', type=str, nargs='+',
-                    help='Paths to images with class annotations')
-parser.add_argument('--window_size', type=int, default=3,
-                    help='Size of window to consider as nearby pixels \
-                            must be odd and >= 3')
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Expand annotations based on similar pixels.')
+    parser.add_argument('image_path', type=str, help='Path to RGB image')
+    parser.add_argument('annotation_paths', type=str, nargs='+',
+                        help='Paths to images with class annotations')
+    parser.add_argument('--window_size', type=int, default=3,
+                        help='Size of window to consider as nearby pixels \
+                                must be odd and >= 3')
+    parser.add_argument('--tile_rows', type=int, default=None,
+                        help='Solve the image in strips of at least this many rows \
+                                to reduce memory use on large images')
+    parser.add_argument('--max_workers', type=int, default=1,
+                        help='Number of strips to solve at once in separate processes \
+                                when using --tile_rows, each one adds to peak memory')
+    parser.add_argument('--iterative', action='store_true',
+                        help='Use an iterative solver which needs less memory \
+                                on large images')
 
-args = parser.parse_args()
-if args.window_size % 2 != 1 or args.window_size < 3:
-    raise AttributeError("Invalid window size. Must be odd and >= 3.")
+    args = parser.parse_args()
+    if args.window_size % 2 != 1 or args.window_size < 3:
+        raise AttributeError("Invalid window size. Must be odd and >= 3.")
 
-load_and_expand(args.image_path, args.annotation_paths, args.window_size)
+    load_and_expand(args.image_path, args.annotation_paths, args.window_size,
+                    tile_rows=args.tile_rows, iterative=args.iterative,
+                    max_workers=args.max_workers)
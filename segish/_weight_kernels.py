@@ -0,0 +1,140 @@
+import numpy as np
+from numba import njit, prange
+
+
+@njit(inline='always')
+def weigh_window(image, annotated, i, j, win_size, w, inv_2var,
+                 out_w, out_ia, out_ib):
+    """Finds the normalised similarity of one window centre to its neighbours
+    and writes them as sparse matrix triplets.
+    Inlined into the kernels so a constant win_size can be fully unrolled.
+
+    Args:
+        image (ndarray): A multi-channel image.
+        annotated (ndarray): 2D boolean array of annotated pixels.
+        i (int): Row of the window's top left pixel.
+        j (int): Column of the window's top left pixel.
+        win_size (int): Size of window for nearby pixels
+        w (ndarray): Scratch array of size win_size * win_size.
+        inv_2var (ndarray): Scratch array with one entry per channel.
+        out_w (ndarray): Output weights with one entry for every
+        non-centre pixel in every window.
+        out_ia (ndarray): Output flat index of each window centre.
+        out_ib (ndarray): Output flat index of each neighbouring pixel.
+
+    """
+    width = image.shape[1]
+    channels = image.shape[2]
+    erode = win_size // 2
+    mid = erode * win_size + erode
+    n_win = win_size * win_size
+    out_cols = width - win_size + 1
+
+    # Shift every exponent by the largest one in the window across all
+    # channels so an outlier in a large window cannot underflow every
+    # weight to 0. The shift cancels out when normalising.
+    # Seeded from the top left pixel, which is never the centre, as
+    # fastmath assumes there are no infinities
+    shift = np.float32(0)
+    for c in range(channels):
+        y = image[i + erode, j + erode, c]
+        # Accumulate both moments in a single read of the window,
+        # in float64 to avoid cancellation when taking the variance
+        sum_x = 0.
+        sum_x2 = 0.
+        for a in range(win_size):
+            for b in range(win_size):
+                x = image[i + a, j + b, c]
+                sum_x += x
+                sum_x2 += x * x
+        mean = sum_x / n_win
+        var = max(sum_x2 / n_win - mean * mean, 0.)
+        # if var is 0 the difference is also 0 so the weight is 1
+        if var > 0:
+            inv_2var[c] = np.float32(0.5 / var)
+        else:
+            inv_2var[c] = np.float32(0)
+        for k in range(n_win):
+            if k == mid:
+                continue
+            d = y - image[i + k // win_size, j + k % win_size, c]
+            e = -d * d * inv_2var[c]
+            if (c == 0 and k == 0) or e > shift:
+                shift = e
+
+    w[:] = 0
+    for c in range(channels):
+        y = image[i + erode, j + erode, c]
+        for k in range(n_win):
+            if k == mid:
+                continue
+            d = y - image[i + k // win_size, j + k % win_size, c]
+            w[k] += np.exp(-d * d * inv_2var[c] - shift)
+    total = np.float32(0)
+    for k in range(n_win):
+        total += w[k]
+    if annotated[i + erode, j + erode]:
+        scale = np.float32(0)
+    else:
+        # Averaging over channels cancels out when normalising
+        scale = np.float32(-1) / total
+
+    centre = (i + erode) * width + j + erode
+    start = (i * out_cols + j) * (n_win - 1)
+    n = 0
+    for k in range(n_win):
+        if k == mid:
+            continue
+        out_w[start + n] = w[k] * scale
+        out_ia[start + n] = centre
+        out_ib[start + n] = (i + k // win_size) * width + j + k % win_size
+        n += 1
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def build_weights_generic(image, annotated, win_size, out_w, out_ia, out_ib):
+    """Finds the normalised similarity of each pixel to its neighbours in a
+    single pass and writes them as sparse matrix triplets.
+    Matches get_w_inter with the window centres and annotated pixels removed
+    as in get_sparse_weights.
+
+    Args:
+        image (ndarray): A multi-channel image.
+        annotated (ndarray): 2D boolean array of annotated pixels.
+        win_size (int): Size of window for nearby pixels
+        out_w (ndarray): Output weights with one entry for every
+        non-centre pixel in every window.
+        out_ia (ndarray): Output flat index of each window centre.
+        out_ib (ndarray): Output flat index of each neighbouring pixel.
+
+    """
+    height, width, channels = image.shape
+    for i in prange(height - win_size + 1):
+        w = np.empty(win_size * win_size, dtype=np.float32)
+        inv_2var = np.empty(channels, dtype=np.float32)
+        for j in range(width - win_size + 1):
+            weigh_window(image, annotated, i, j, win_size, w, inv_2var,
+                         out_w, out_ia, out_ib)
+
+
+@njit(parallel=True, fastmath=True, cache=True, boundscheck=False)
+def build_weights_win3(image, annotated, out_w, out_ia, out_ib):
+    """Same as build_weights_generic specialised for the default 3 x 3 window
+    so the window loops are fully unrolled.
+
+    Args:
+        image (ndarray): A multi-channel image.
+        annotated (ndarray): 2D boolean array of annotated pixels.
+        out_w (ndarray): Output weights with one entry for every
+        non-centre pixel in every window.
+        out_ia (ndarray): Output flat index of each window centre.
+        out_ib (ndarray): Output flat index of each neighbouring pixel.
+
+    """
+    height, width, channels = image.shape
+    for i in prange(height - 2):
+        w = np.empty(9, dtype=np.float32)
+        inv_2var = np.empty(channels, dtype=np.float32)
+        for j in range(width - 2):
+            weigh_window(image, annotated, i, j, 3, w, inv_2var,
+                         out_w, out_ia, out_ib)
@@ -1,11 +1,23 @@
+import multiprocessing
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
 import numpy as np
-from scipy.sparse.linalg import splu
+from scipy.sparse.linalg import LinearOperator, bicgstab, spilu, splu
+
+try:
+    # UMFPACK factorises faster than SuperLU but is an optional dependency
+    from scikits.umfpack import splu as umfpack_splu
+except ImportError:
+    umfpack_splu = None
 
 from .image_handling import load_image_with_annotations, save_adjacent
-from .weight_generation import get_sparse_weights
+from .weight_generation import get_sparse_weights, set_kernel_threads
 
 
-def load_and_expand(image_path, annotation_paths, window_size=3):
+def load_and_expand(image_path, annotation_paths, window_size=3, buffer=None,
+                    tile_rows=None, iterative=False, max_workers=1):
     """Expands rough annotations loaded from disk to fill likely object boundaries
     and saves results.
 
@@ -15,55 +27,199 @@ def load_and_expand(image_path, annotation_paths, window_size=3):
         saved as seperate images
         window_size (int): Sets the window size to consider when determining
         pixel colour. The defualt will work for most situations.
+        buffer (ndarray): Optional float32 array matching the RGB image shape
+        to load the normalised image into. Reusing one buffer avoids
+        reallocating it when expanding many images of the same size.
+        tile_rows (int): If set the image is solved in strips of at least
+        this many rows to limit memory use. See expand_annotations.
+        iterative (bool): Use an iterative solver which needs less memory
+        than the default direct solver on large images. Results are
+        approximate so pixels near a tie between classes may be labelled
+        differently.
+        max_workers (int): Number of strips solved at once when tile_rows
+        is set. See expand_annotations.
 
     """
-    img, ann = load_image_with_annotations(image_path, annotation_paths)
-    expanded_ann = expand_annotations(img, ann, window_size)
+    img, ann = load_image_with_annotations(image_path, annotation_paths,
+                                           buffer=buffer)
+    expanded_ann = expand_annotations(img, ann, window_size, tile_rows,
+                                      iterative, max_workers)
     save_adjacent(annotation_paths, expanded_ann)
 
 
-def expand_annotations(image, annotations, window_size=3):
+def expand_annotations(image, annotations, window_size=3, tile_rows=None,
+                       iterative=False, max_workers=1):
     """Expands rough annotations to fill likely object boundaries.
 
     Args:
         image (ndarray): Multichannel image
         annotations(ndarray): Multichannel annotations
         window_size (int): Sets the window size to consider when determining
+        tile_rows (int): If set the image is split into horizontal strips of
+        at least this many rows which are solved independently.
+        This bounds memory use on large images but annotations can only
+        spread within their own strip.
+        iterative (bool): Use an iterative solver which needs less memory
+        than the default direct solver on large images. Results are
+        approximate so pixels near a tie between classes may be labelled
+        differently.
+        max_workers (int): Number of strips solved at once in separate
+        processes when tile_rows is set. Peak memory grows with each extra
+        worker so the default of 1 solves one strip at a time in process.
 
     Returns:
         ndarray: Binary annotations saved as seperate channels
 
 
     """
-    w = get_sparse_weights(image, annotations, window_size)
-    expanded_annotations = solve_for_annotations_and_weights(annotations, w)
+    if tile_rows is None:
+        expanded_annotations = solve_for_image(image, annotations, window_size,
+                                               iterative)
+    else:
+        expanded_annotations = solve_in_strips(image, annotations, window_size,
+                                               tile_rows, iterative, max_workers)
     expanded_annotations = argmax_annotations(expanded_annotations)
     return expanded_annotations
 
 
-def solve_for_annotations_and_weights(annotations, w):
+def solve_for_image(image, annotations, window_size, iterative=False):
+    """Builds the pixel similarity weights for an image and solves for the
+    spread of its annotations.
+
+    Args:
+        image (ndarray): Multichannel image
+        annotations(ndarray): Multichannel annotations
+        window_size (int): Size of window for nearby pixels
+        iterative (bool): Use the iterative solver
+
+    Returns:
+        ndarray: New annotations based on optimisation of pixel similarities
+
+    """
+    w = get_sparse_weights(image, annotations, window_size)
+    return solve_for_annotations_and_weights(annotations, w, iterative)
+
+
+def solve_in_strips(image, annotations, window_size, tile_rows, iterative=False,
+                    max_workers=1):
+    """Solves for the spread of annotations separately in horizontal strips.
+    Each strip is extended by half a window on both sides so its own rows
+    are not on the unsolved strip edge, neighbouring strips therefore
+    overlap by window_size - 1 rows.
+    Peak memory is roughly one strip's weights and factorisation per worker.
+    With more than one worker strips are solved in separate processes, so
+    scripts calling this need an if __name__ == '__main__' guard, and each
+    process's numba kernels get an equal share of the cores.
+
+    Args:
+        image (ndarray): Multichannel image
+        annotations(ndarray): Multichannel annotations
+        window_size (int): Size of window for nearby pixels
+        tile_rows (int): Minimum number of rows in each strip
+        iterative (bool): Use the iterative solver
+        max_workers (int): Number of strips solved at once
+
+    Returns:
+        ndarray: New annotations based on optimisation of pixel similarities
+
+    """
+    if tile_rows < window_size:
+        raise AttributeError("Invalid tile rows. Must be >= window size.")
+    erode = int(window_size / 2)
+    height = image.shape[0]
+    n_strips = max(1, height // tile_rows)
+    bounds = np.linspace(0, height, n_strips + 1).astype(int)
+    starts = np.maximum(bounds[:-1] - erode, 0)
+    stops = np.minimum(bounds[1:] + erode, height)
+
+    images = (image[a:b] for a, b in zip(starts, stops))
+    anns = (annotations[a:b] for a, b in zip(starts, stops))
+    expanded_annotations = np.empty(annotations.shape)
+    max_workers = min(max_workers, n_strips)
+    if max_workers <= 1:
+        solutions = map(solve_for_image, images, anns,
+                        repeat(window_size), repeat(iterative))
+        for solution, start, a, b in zip(solutions, starts, bounds[:-1], bounds[1:]):
+            expanded_annotations[a:b] = solution[a - start:b - start]
+        return expanded_annotations
+
+    # Spawn rather than fork as forking after numba has started its threads
+    # can deadlock
+    context = multiprocessing.get_context('spawn')
+    n_threads = max(1, multiprocessing.cpu_count() // max_workers)
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=context,
+                             initializer=set_kernel_threads,
+                             initargs=(n_threads,)) as executor:
+        solutions = executor.map(solve_for_image, images, anns,
+                                 repeat(window_size), repeat(iterative))
+        for solution, start, a, b in zip(solutions, starts, bounds[:-1], bounds[1:]):
+            expanded_annotations[a:b] = solution[a - start:b - start]
+    return expanded_annotations
+
+
+def solve_for_annotations_and_weights(annotations, w, iterative=False):
     """Finds optimal spread of annotations based on initial annotations
     and pixel similarities.
 
     Args:
         annotations(ndarray): Multichannel annotations
         w (scipy.sparse.csc_matrix): Sparse representations of nearby pixel similarity
+        iterative (bool): Use an approximate iterative solver instead of
+        a direct LU, see solve_iteratively
 
     Returns:
         ndarray: New annotations based on optimisation of pixel similarities
 
 
     """
-    solver = splu(w)
-    expanded_annotations = []
-    for i in range(annotations.shape[2]):
-        solution = solver.solve(annotations[..., i].astype('float32').flatten())
-        solution = solution.reshape(annotations.shape[:2])
-        expanded_annotations.append(solution)
-    expanded_annotations = np.stack(expanded_annotations, axis=2)
+    rhs = annotations.astype('float32').reshape(-1, annotations.shape[2])
+    if iterative:
+        solution = solve_iteratively(w, rhs)
+    else:
+        # w is row normalised so it is not symmetric and needs a general LU
+        if umfpack_splu is not None:
+            solver = umfpack_splu(w)
+        else:
+            # The sparsity pattern is close to symmetric so order on A^T + A
+            solver = splu(w, options=dict(ColPerm='MMD_AT_PLUS_A'))
+        # Solve all channels at once with each channel as a column of the rhs
+        solution = solver.solve(np.asfortranarray(rhs))
+    expanded_annotations = solution.reshape(annotations.shape)
     return expanded_annotations
 
 
+def solve_iteratively(w, rhs):
+    """Solves for each column of rhs with preconditioned BiCGSTAB.
+    This avoids the fill-in of a full LU factorisation so uses much less
+    memory on large images. Each class stops at a fixed absolute residual
+    so accuracy does not depend on how much is annotated, but the result
+    is still approximate and labels of pixels near a tie between classes
+    can differ from the direct solve.
+
+    Args:
+        w (scipy.sparse.csc_matrix): Sparse representations of nearby pixel similarity
+        rhs (ndarray): 2D array with a column of flattened annotations per class
+
+    Returns:
+        ndarray: 2D array with a column of solved annotations per class
+
+    """
+    # w has a unit diagonal so Jacobi preconditioning would do nothing,
+    # an incomplete LU is used instead
+    ilu = spilu(w, drop_tol=1e-3)
+    preconditioner = LinearOperator(w.shape, ilu.solve)
+    solution = np.empty(rhs.shape)
+    for i in range(rhs.shape[1]):
+        # Annotated pixels are fixed to their rhs value so start from there
+        # A relative tolerance would loosen as more pixels are annotated
+        solution[:, i], info = bicgstab(w, rhs[:, i], x0=rhs[:, i],
+                                        M=preconditioner, rtol=0, atol=1e-6)
+        if info != 0:
+            warnings.warn(f"Iterative solve for class {i} did not converge.",
+                          RuntimeWarning)
+    return solution
+
+
 def argmax_annotations(annotations):
     """Selects thre most likely class for each pixel and sets the
     pixel to only that class.
@@ -72,12 +228,14 @@ def argmax_annotations(annotations):
         annotations(ndarray): Multichannel annotations
 
     Returns:
-        ndarray: Argmaxed annotations
+        ndarray: Argmaxed annotations as uint8
 
      """
+    n_classes = annotations.shape[2]
     most_likely_class = np.argmax(annotations, axis=2)
-    m_anns = annotations.copy()
-    for i in range(annotations.shape[2]):
-        m_anns[..., i][most_likely_class != i] = 0
-    m_anns[m_anns > 0] = 1
-    return m_anns
+    # Pixels with no positive class value are left unannotated by pointing
+    # them at the extra all zero row of the one hot lookup
+    best = np.take_along_axis(annotations, most_likely_class[..., np.newaxis], axis=2)
+    most_likely_class[best[..., 0] <= 0] = n_classes
+    one_hot = np.eye(n_classes + 1, n_classes, dtype=np.uint8)
+    return one_hot[most_likely_class]
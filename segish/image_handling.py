@@ -1,36 +1,44 @@
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import imageio.v3 as iio
 import numpy as np
 
 
-def load_image_with_annotations(image_path, annotation_paths, down_scaling=1):
+def load_image_with_annotations(image_path, annotation_paths, down_scaling=1,
+                                buffer=None):
     """ Loads and normalises images and rough segmentation annotations.
     Assumes images as rgb uint8.
     Removes alpha channel if present.
+    The normalised image is written into buffer if given, so repeated loads
+    of same sized images can reuse one float32 array.
     """
     img = iio.imread(image_path)
     if down_scaling != 1:
         img = img[::down_scaling, ::down_scaling]
-    img = img / 255
+    # Slicing is a view so drop alpha before normalising to skip converting it
     if img.shape[2] > 3:
-        img = img[..., :2]
+        img = img[..., :3]
+    if buffer is None:
+        buffer = np.empty(img.shape, dtype=np.float32)
+    elif buffer.shape != img.shape:
+        raise ValueError(f"Buffer shape {buffer.shape} does not match "
+                         f"image shape {img.shape}.")
+    img = np.multiply(img, np.float32(1 / 255), out=buffer)
 
-    ann_l = []
-    for ann_path in annotation_paths:
+    anns = np.empty(img.shape[:2] + (len(annotation_paths),), dtype=np.float32)
+    for k, ann_path in enumerate(annotation_paths):
         ann = iio.imread(ann_path)
         if down_scaling != 1:
             ann = ann[::down_scaling, ::down_scaling]
         if ann.shape[2] > 3:
-            ann = ann[..., :2]
+            ann = ann[..., :3]
 
-        ann = np.sum(ann, axis=2)
+        # Three uint8 channels sum exactly in uint16 so skip converting to float
+        sum_dtype = np.uint16 if ann.dtype == np.uint8 else np.float32
+        ann = ann.sum(axis=2, dtype=sum_dtype)
         # Image loading adds extra pixels which this removes
-        ann[ann < ann.max() / 20] = 0.
-        ann[ann > ann.max() / 20] = 1.
-        ann_l.append(ann)
-    
-    anns = np.stack(ann_l, axis=2)
+        np.greater(ann, ann.max() / 20, out=anns[..., k])
 
     return img, anns
 
@@ -53,5 +61,7 @@ def save_annotations(out_paths, anns):
     Assumes segmentation values in range 0-1.
     """
     assert(len(out_paths) == anns.shape[2])
-    for i in range(len(out_paths)):
-        iio.imwrite(out_paths[i], (anns[..., i] * 255).astype(np.uint8))
+    channels = ((anns[..., i] * 255).astype(np.uint8) for i in range(len(out_paths)))
+    # Encoding and writing release the GIL so save all classes concurrently
+    with ThreadPoolExecutor(max_workers=min(8, len(out_paths))) as executor:
+        list(executor.map(iio.imwrite, out_paths, channels))
@@ -1,43 +1,76 @@
 import numpy as np
 from scipy import sparse
 
+try:
+    from numba import set_num_threads
+
+    from ._weight_kernels import build_weights_generic, build_weights_win3
+except ImportError:
+    # numba is optional, without it the NumPy implementation is used
+    set_num_threads = build_weights_generic = build_weights_win3 = None
+
 
 def rolling_window(image, win_size):
     """Creates a new ndarray made of a rolling square window.
     No padding is used the edge pixels are cut.
+    Any trailing channel axis is kept after the window axes.
 
     Args:
-        image (ndarray): 2D array to roll window over
+        image (ndarray): 2D or 3D array to roll window over
         win_size (int): Size of window
 
     Returns:
-        ndarray: 4D Array where element (i,j) is a size x size window
+        ndarray: 4D or 5D Array where element (i,j) is a size x size window
         centred on element (i, j) in image.
 
     """
     if win_size % 2 != 1 or win_size < 3:
         raise AttributeError("Invalid window size. Must be odd and >= 3.")
     s = (image.shape[0] - win_size + 1,) + (image.shape[1] - win_size + 1,)
-    s += (win_size, win_size)
-    strides = image.strides + image.strides
+    s += (win_size, win_size) + image.shape[2:]
+    strides = image.strides[:2] + image.strides
     return np.lib.stride_tricks.as_strided(image, shape=s, strides=strides)
 
 
-def expand_to_window(image, win_size):
-    """Creates a new 4D ndarray by copying elements of a 2D array.
+def expand_to_window(image):
+    """Creates a view of an array that broadcasts against rolling windows.
 
     Args:
-        image (ndarray): 2D array to copy.
-        win_size (int): Size of window.
+        image (ndarray): 2D or 3D array to expand.
+
+    Returns:
+        ndarray: 4D or 5D Array where element (i,j) is a 1 x 1 array
+        equal to element (i, j) in image.
+
+    """
+    return image[:, :, np.newaxis, np.newaxis]
+
+
+def set_kernel_threads(n_threads):
+    """Limits the number of threads used by the numba kernels in this process.
+    Does nothing if numba is not installed.
+
+    Args:
+        n_threads (int): Maximum number of threads.
+
+    """
+    if set_num_threads is not None:
+        set_num_threads(n_threads)
+
+
+def get_index_dtype(shape):
+    """Picks the smallest integer type that can hold a flattened pixel index.
+
+    Args:
+        shape (tuple[int]): The size of the image being indexed.
 
     Returns:
-        ndarray: 4D Array where element (i,j) is a size x size array
-        where every element equals element (i, j) in image.
+        dtype: int32 if it fits otherwise int64.
 
     """
-    image_new = image[..., np.newaxis, np.newaxis]
-    image_new = np.tile(image_new, (1, 1, win_size, win_size))
-    return image_new
+    if shape[0] * shape[1] < 2 ** 31:
+        return np.int32
+    return np.int64
 
 
 def index_window(shape, win_size):
@@ -54,18 +87,44 @@ def index_window(shape, win_size):
     """
     erode = int(win_size / 2)
     num = shape[0] * shape[1]
-    idx = np.arange(num)
+    idx = np.arange(num, dtype=get_index_dtype(shape))
     idx = np.reshape(idx, shape)
-    idx_a = expand_to_window(idx[erode:-erode, erode:-erode], win_size)
     idx_b = rolling_window(idx, win_size)
+    idx_a = expand_to_window(idx[erode:-erode, erode:-erode])
+    idx_a = np.broadcast_to(idx_a, idx_b.shape)
     return idx_a, idx_b
 
 
+def window_sum(image, win_size):
+    """Sums rolling windows across an array using a summed-area table
+    so the cost does not depend on the window size.
+    No padding is used the edge pixels are cut.
+
+    Args:
+        image (ndarray): 2D or 3D array to roll window over
+        win_size (int): Size of window
+
+    Returns:
+        ndarray: Array where element (i,j) is the sum of a size x size window
+        centred on element (i, j) in image.
+
+    """
+    if win_size % 2 != 1 or win_size < 3:
+        raise AttributeError("Invalid window size. Must be odd and >= 3.")
+    # Accumulate in float64 so large images do not lose precision
+    table = np.zeros((image.shape[0] + 1, image.shape[1] + 1) + image.shape[2:])
+    np.cumsum(image, axis=0, dtype=np.float64, out=table[1:, 1:])
+    np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+    return (table[win_size:, win_size:] - table[:-win_size, win_size:]
+            - table[win_size:, :-win_size] + table[:-win_size, :-win_size])
+
+
 def get_mean_std(image, win_size):
-    """Finds the mean and standard deviation of rolling windows across a 2D array.
+    """Finds the mean and standard deviation of rolling windows across an array.
+    Channels are treated independently.
 
     Args:
-        image (ndarray): 2D array to roll window over
+        image (ndarray): 2D or 3D array to roll window over
         win_size (int): Size of window
 
     Returns:
@@ -75,37 +134,49 @@ def get_mean_std(image, win_size):
         size x size window centred on element (i, j) in image.
 
     """
-    windows = rolling_window(image, win_size)
-    mean = np.mean(windows, axis=(2, 3))
-    std = np.std(windows, axis=(2, 3))
-    return mean, std
+    n = win_size * win_size
+    mean = window_sum(image, win_size) / n
+    mean_sq = window_sum(image ** 2, win_size) / n
+    # Rounding can leave tiny negative variances on flat windows
+    std = np.sqrt(np.maximum(mean_sq - mean ** 2, 0))
+    return mean.astype(image.dtype, copy=False), std.astype(image.dtype, copy=False)
 
 
 def get_w_2D(image, win_size):
     """Finds the squared difference between the values in nearby pixels.
+    Channels are treated independently.
 
     Args:
-        image (ndarray): A single channel from an image.
+        image (ndarray): A single channel or multi-channel image.
         win_size (int): Size of window for nearby pixels
 
     Returns:
-        ndarray: 4D array where element (i,j) is a win_size x win_size array of
-        the differences between element (i,j) from image
-        and the pixels neighbouring it.
+        ndarray: 4D or 5D array where element (i,j) is a win_size x win_size
+        array of the differences between element (i,j) from image
+        and the pixels neighbouring it, scaled by a constant per window.
 
     """
     erode = int(win_size/2)
     _, std = get_mean_std(image, win_size)
     windows = rolling_window(image, win_size)
-    
-    yr = expand_to_window(image[erode:-erode, erode:-erode], win_size)
-    yrs = (yr - windows) ** 2
-    # if yrs is 0 std dev will also be 0 so ignore 0/0 errors and set results to 0
-    with np.errstate(invalid='ignore'):
-        exp = -yrs / expand_to_window(2 * (std ** 2), win_size)
-    exp[np.isnan(exp)] = 0
-    w = np.exp(exp)
-    w[:, :, erode, erode] = 0
+
+    # Scale per window rather than per element.
+    # If std dev is 0 the differences will also be 0 so set the scale to 0
+    denom = np.float32(2) * (std ** 2)
+    scale = np.zeros_like(denom)
+    np.divide(-1, denom, out=scale, where=denom > 0)
+
+    # Reuse one buffer for every step over the full window array
+    yr = expand_to_window(image[erode:-erode, erode:-erode])
+    w = np.subtract(yr, windows)
+    np.square(w, out=w)
+    np.multiply(w, expand_to_window(scale), out=w)
+    # Shift each window so its largest exponent is 0, otherwise an outlier
+    # in a large window underflows every weight to 0 in float32.
+    # The shift is shared by all channels so it cancels when normalising
+    w[:, :, erode, erode] = -np.inf
+    w -= np.max(w, axis=tuple(range(2, w.ndim)), keepdims=True)
+    np.exp(w, out=w)
     return w
 
 
@@ -124,14 +195,9 @@ def get_w_inter(image, win_size):
 
     """
     erode = int(win_size/2)
-    w3D = []
-    for i in range(image.shape[-1]):
-        w3D.append(get_w_2D(image[..., i], win_size))
-    w3d = np.stack(w3D, axis=2)
-    w = np.mean(w3d, axis=2)
+    w = np.mean(get_w_2D(image, win_size), axis=-1)
     sums = np.sum(w, axis=(2, 3))
-    w = w / expand_to_window(sums, win_size)
-    w = -w
+    w /= -expand_to_window(sums)
     w[:, :, erode, erode] = 1
     return w
 
@@ -150,36 +216,93 @@ def get_sparse_weights(image, ann, win_size=3):
         csc_matrix: Sparse 2D array where element (i,j) is the difference
         between pixel i and pixel j.
     """
+    if win_size % 2 != 1 or win_size < 3:
+        raise AttributeError("Invalid window size. Must be odd and >= 3.")
+    size = image.shape[0] * image.shape[1]
+    n_windows = (image.shape[0] - win_size + 1) * (image.shape[1] - win_size + 1)
+    n_edges = n_windows * (win_size * win_size - 1)
+
+    # Weights and diagonals share one buffer so nothing is concatenated.
+    # Weights are computed in float32 but SuperLU needs them as float64
+    idx_dtype = get_index_dtype(image.shape)
+    w = np.empty(n_edges + size)
+    idx_a = np.empty(n_edges + size, dtype=idx_dtype)
+    idx_b = np.empty(n_edges + size, dtype=idx_dtype)
+
     # Get weights and associated idxs
+    if build_weights_generic is not None:
+        get_flat_weights_compiled(image, ann, win_size,
+                                  w[:n_edges], idx_a[:n_edges], idx_b[:n_edges])
+    else:
+        get_flat_weights(image, ann, win_size,
+                         w[:n_edges], idx_a[:n_edges], idx_b[:n_edges])
+
+    # Fill in all diagonals including those not contained in W
+    w[n_edges:] = 1
+    idx_a[n_edges:] = np.arange(size)
+    idx_b[n_edges:] = idx_a[n_edges:]
+
+    # Build as COO so SciPy can use its fast path when converting to CSC,
+    # which also sums any duplicate entries
+    sparse_w = sparse.coo_matrix((w, (idx_a, idx_b)), shape=(size, size))
+    return sparse_w.tocsc()
+
+
+def get_flat_weights(image, ann, win_size, out_w, out_ia, out_ib):
+    """Finds the weights between nearby pixels and their flattened indexes
+    with the window centres removed. Annotated pixels have zero weights.
+
+    Args:
+        image (ndarray): A multi-channel image.
+        ann (ndarray): Multi-channel annotations
+        win_size (int): Size of window for nearby pixels
+        out_w (ndarray): Output weights with one entry for every
+        non-centre pixel in every window.
+        out_ia (ndarray): Output flat index of each window centre.
+        out_ib (ndarray): Output flat index of each neighbouring pixel.
+
+    """
     mid = int(win_size / 2)
-    w = get_w_inter(image, win_size) 
-    
+    w = get_w_inter(image, win_size)
+
     seg_idx = get_ann_in_w(ann, win_size)
     w[seg_idx] = 0
-    
+
     idx_a, idx_b = index_window(image.shape[:2], win_size)
-    idx_a = idx_a.flatten()
-    idx_b = idx_b.flatten()
-    
+
     # Remove all diagonals when flattening w as they will be filled in later
-    w[..., mid, mid] = np.nan
-    w = w.flatten()
-    idx_a = idx_a[~np.isnan(w)]
-    idx_b = idx_b[~np.isnan(w)]
-    w = w[~np.isnan(w)]
-    
-    # Fill in all diagonals including those not contained in W
-    size = image.shape[0] * image.shape[1]
-    diags_idx = np.arange(size)
-    diags_v = np.ones(size)
-    
-    w = np.concatenate([w, diags_v], axis=0)
-    idx_a = np.concatenate([idx_a, diags_idx], axis=0)
-    idx_b = np.concatenate([idx_b, diags_idx], axis=0)
-    
-    sparse_w = sparse.csc_matrix((w, (idx_a, idx_b)), (size, size))
-    return sparse_w
-    
+    n = win_size * win_size
+    centre = mid * win_size + mid
+    for src, out in ((w, out_w), (idx_a, out_ia), (idx_b, out_ib)):
+        src = src.reshape(w.shape[:2] + (n,))
+        out = out.reshape(w.shape[:2] + (n - 1,))
+        out[..., :centre] = src[..., :centre]
+        out[..., centre:] = src[..., centre + 1:]
+
+
+def get_flat_weights_compiled(image, ann, win_size, out_w, out_ia, out_ib):
+    """Same as get_flat_weights but uses the compiled numba kernels which avoid
+    creating any window sized intermediate arrays.
+    The default window size has its own fully unrolled kernel.
+
+    Args:
+        image (ndarray): A multi-channel image.
+        ann (ndarray): Multi-channel annotations
+        win_size (int): Size of window for nearby pixels
+        out_w (ndarray): Output weights with one entry for every
+        non-centre pixel in every window.
+        out_ia (ndarray): Output flat index of each window centre.
+        out_ib (ndarray): Output flat index of each neighbouring pixel.
+
+    """
+    # The kernels expect C ordered arrays whatever the layout of the inputs
+    annotated = np.ascontiguousarray(np.sum(ann, axis=2) != 0)
+    image = np.ascontiguousarray(image, dtype=np.float32)
+    if win_size == 3:
+        build_weights_win3(image, annotated, out_w, out_ia, out_ib)
+    else:
+        build_weights_generic(image, annotated, win_size, out_w, out_ia, out_ib)
+
 
 def get_ann_in_w(ann, win_size):
     """Creates a boolean index for annotated pixels that 
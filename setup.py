@@ -3,9 +3,10 @@ import re
 import setuptools
 
 VERSIONFILE="segish/_version.py"
-verstrline = open(VERSIONFILE, "rt").read()
-VSRE = r"^__version__ = ['\"]([^'\"]*)['\"]"
-mo = re.search(VSRE, verstrline, re.M)
+VSRE = re.compile(r"^__version__ = ['\"]([^'\"]*)['\"]", re.M)
+with open(VERSIONFILE, "rt") as fh:
+    verstrline = fh.read()
+mo = VSRE.search(verstrline)
 if mo:
     verstr = mo.group(1)
 else:
@@ -28,9 +29,10 @@ setuptools.setup(
         "Programming Language :: Python :: 3",
         "Operating System :: OS Independent",
     ],
-    python_requires=">=3.5",
+    python_requires=">=3.9",
     install_requires=[
         "numpy",
+        "scipy>=1.12",
         "imageio",
         "scikit-learn"
     ]
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from segish import weight_generation
+from segish.expand_annotations import expand_annotations
+
+requires_numba = pytest.mark.skipif(weight_generation.build_weights_generic is None,
+                                    reason="numba is not installed")
+
+
+def make_image_and_annotations(height=30, width=40):
+    rng = np.random.default_rng(0)
+    image = np.zeros((height, width, 3), dtype=np.float32)
+    image[:, :width // 2] = [0.8, 0.2, 0.1]
+    image[:, width // 2:] = [0.1, 0.3, 0.9]
+    image += rng.normal(0, 0.05, image.shape).astype(np.float32)
+    ann = np.zeros((height, width, 2), dtype=np.float32)
+    ann[5:-5, 4, 0] = 1
+    ann[5:-5, -5, 1] = 1
+    return image, ann
+
+
+@requires_numba
+@pytest.mark.parametrize("win_size", [3, 5])
+def test_compiled_weights_match_numpy(monkeypatch, win_size):
+    image, ann = make_image_and_annotations()
+    compiled = weight_generation.get_sparse_weights(image, ann, win_size)
+    monkeypatch.setattr(weight_generation, "build_weights_generic", None)
+    numpy_w = weight_generation.get_sparse_weights(image, ann, win_size)
+    assert abs(compiled - numpy_w).max() < 1e-5
+
+
+@requires_numba
+@pytest.mark.parametrize("win_size", [3, 5])
+@pytest.mark.parametrize("layout", [np.asfortranarray, lambda a: a[:, :, ::-1]])
+def test_compiled_weights_accept_non_c_ordered_annotations(win_size, layout):
+    image, ann = make_image_and_annotations()
+    expected = weight_generation.get_sparse_weights(image, ann, win_size)
+    result = weight_generation.get_sparse_weights(image, layout(ann), win_size)
+    assert abs(result - expected).max() == 0
+    # Compare with the same annotations as a C ordered copy, so the
+    # reordered channels still map to the same classes
+    labels = expand_annotations(np.asfortranarray(image), layout(ann), win_size)
+    expected_labels = expand_annotations(image, np.ascontiguousarray(layout(ann)),
+                                         win_size)
+    assert (labels == expected_labels).all()
+
+
+@pytest.mark.parametrize("compiled", [
+    pytest.param(True, marks=requires_numba), False])
+def test_isolated_outlier_in_large_window(monkeypatch, compiled):
+    # exp(-d^2 / 2 var) underflows in float32 for every neighbour of the
+    # outlier unless the exponents are shifted per window
+    image = np.zeros((40, 40, 3), dtype=np.float32)
+    image[20, 20] = 1
+    _, ann = make_image_and_annotations(40, 40)
+    if not compiled:
+        monkeypatch.setattr(weight_generation, "build_weights_generic", None)
+    w = weight_generation.get_sparse_weights(image, ann, 15)
+    assert np.isfinite(w.data).all()
+    # Pixels within half a window of the border are never window centres
+    labels = expand_annotations(image, ann, 15)[7:-7, 7:-7]
+    assert (labels.sum(axis=2) == 1).all()